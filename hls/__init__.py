@@ -1,17 +1,42 @@
 import io
 import os
+import re
+import sys
+import mmap
+import queue
+import shutil
+from collections import deque
+from contextlib import ExitStack
 from abc import ABC, abstractmethod
 from urllib.parse import urljoin
-from typing import Callable, IO, List
-from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, IO, List, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from Crypto.Cipher import AES
 from tqdm import tqdm
 
 
 Get = Callable[[str, IO], None]
 
+BLOCK_BATCH = 1 << 20
+WRITEV_BATCH = 16
+
+
+def writev(fd: int, buffers: List[memoryview]):
+    buffers = list(buffers)
+    while buffers:
+        if hasattr(os, "writev"):
+            n = os.writev(fd, buffers)
+        else:
+            n = os.write(fd, buffers[0])
+        while buffers and n >= len(buffers[0]):
+            n -= len(buffers.pop(0))
+        if n:
+            buffers[0] = buffers[0][n:]
+
 
 class BS:
 
@@ -33,20 +58,64 @@ class Decoder(ABC):
     def decode(self, content: bytes):
         raise NotImplementedError
 
+    def copy(self, src: IO, dst: IO):
+        dst.write(self.decode(src.read()))
+
+
+class ChunkDecoder(Decoder):
+
+    @abstractmethod
+    def decode_chunk(self, src: memoryview, offset: int, dst: memoryview):
+        raise NotImplementedError
+
 
 class DefaultDecoder(Decoder):
 
+    def __init__(self):
+        self.copy_file_range = getattr(os, "copy_file_range", None)
+
     def decode(self, content: bytes):
         return content
 
+    def copy(self, src: IO, dst: IO):
+        if not sys.platform.startswith("linux"):
+            shutil.copyfileobj(src, dst, length=BLOCK_BATCH)
+            return
+        in_fd, out_fd = src.fileno(), dst.fileno()
+        size = os.fstat(in_fd).st_size
+        offset = 0
+        while offset < size:
+            if self.copy_file_range is not None:
+                try:
+                    sent = self.copy_file_range(in_fd, out_fd, size - offset, offset)
+                except OSError:
+                    sent = 0
+                if sent == 0:
+                    self.copy_file_range = None
+                    continue
+            else:
+                sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+                if sent == 0:
+                    break
+            offset += sent
+
 
-class AESDecoder(Decoder):
+class AESDecoder(ChunkDecoder):
 
     def __init__(self, key: bytes, iv: bytes):
-        self.aes = AES.new(key=key, IV=iv, mode=AES.MODE_CBC)
+        self.key = key
+        self.iv = iv
+
+    def new_cipher(self, iv: bytes = None):
+        return AES.new(key=self.key, IV=self.iv if iv is None else iv, mode=AES.MODE_CBC)
 
     def decode(self, content: bytes):
-        return self.aes.decrypt(content)
+        return self.new_cipher().decrypt(content)
+
+    def decode_chunk(self, src: memoryview, offset: int, dst: memoryview):
+        iv = None if offset == 0 else bytes(src[offset - AES.block_size:offset])
+        with src[offset:offset + len(dst)] as chunk:
+            self.new_cipher(iv).decrypt(chunk, output=dst)
 
 
 class Cache:
@@ -55,21 +124,103 @@ class Cache:
         self.directory = directory
         self.get1 = get1
 
-    def get(self, url: str):
+    def get_file_path(self, url: str) -> str:
         _, url_suffix = url.rsplit("/", 1)
-        file_path = os.path.join(self.directory, url_suffix)
+        return os.path.join(self.directory, url_suffix)
+
+    def get(self, url: str, file_path: str):
         if os.path.exists(file_path):
             return
-        with open(file_path, "wb") as f:
+        part_path = file_path + ".part"
+        with open(part_path, "wb") as f:
             self.get1(url, f)
+        os.replace(part_path, file_path)
 
-    def merge(self, url_list: List[str], file_path: str, decoder: Decoder):
-        with open(file_path, "wb") as f:
-            for url in url_list:
-                _, url_suffix = url.rsplit("/", 1)
-                file_path1 = os.path.join(self.directory, url_suffix)
-                with open(file_path1, "rb") as g:
-                    f.write(decoder.decode(g.read()))
+    @staticmethod
+    def open_segment(file_path: str) -> Tuple[ExitStack, memoryview]:
+        with ExitStack() as stack:
+            g = stack.enter_context(open(file_path, "rb"))
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(g.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                stack.callback(os.posix_fadvise, g.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            if os.fstat(g.fileno()).st_size == 0:
+                return stack.pop_all(), memoryview(b"")
+            mm = stack.enter_context(mmap.mmap(g.fileno(), 0, access=mmap.ACCESS_READ))
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            view = stack.enter_context(memoryview(mm))
+            return stack.pop_all(), view
+
+    @staticmethod
+    def decrypt_batch(decoder: ChunkDecoder, src: memoryview, offset: int, buffers: queue.SimpleQueue) -> memoryview:
+        try:
+            buffer = buffers.get_nowait()
+        except queue.Empty:
+            buffer = bytearray(BLOCK_BATCH)
+        dst = memoryview(buffer)[:min(BLOCK_BATCH, len(src) - offset)]
+        decoder.decode_chunk(src, offset, dst)
+        return dst
+
+    @staticmethod
+    def merge_parallel(f: IO, file_path_list: List[str], decoder: ChunkDecoder, max_workers: int):
+        buffers = queue.SimpleQueue()
+        futures = deque()
+        stacks = []
+        pending = []
+
+        def drain():
+            future, stack = futures.popleft()
+            try:
+                pending.append(future.result())
+            finally:
+                if stack is not None:
+                    stack.close()
+            if len(pending) >= WRITEV_BATCH:
+                writev(f.fileno(), pending)
+                for dst in pending:
+                    buffers.put(dst.obj)
+                pending.clear()
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for file_path in file_path_list:
+                    stack, src = Cache.open_segment(file_path)
+                    stacks.append(stack)
+                    if len(src) == 0:
+                        stack.close()
+                        continue
+                    for offset in range(0, len(src), BLOCK_BATCH):
+                        future = executor.submit(Cache.decrypt_batch, decoder, src, offset, buffers)
+                        futures.append((future, stack if offset + BLOCK_BATCH >= len(src) else None))
+                        if len(futures) > 2 * max_workers:
+                            drain()
+                while futures:
+                    drain()
+            writev(f.fileno(), pending)
+        finally:
+            for stack in stacks:
+                stack.close()
+
+    def merge(self, file_path_list: List[str], file_path: str, decoder: Decoder, max_workers: int = 4):
+        with open(file_path, "wb", buffering=0) as f:
+            if hasattr(os, "posix_fallocate"):
+                total = sum(os.path.getsize(file_path1) for file_path1 in file_path_list)
+                if total > 0:
+                    try:
+                        os.posix_fallocate(f.fileno(), 0, total)
+                    except OSError:
+                        pass
+            if isinstance(decoder, ChunkDecoder):
+                Cache.merge_parallel(f, file_path_list, decoder, max_workers)
+            else:
+                for file_path1 in file_path_list:
+                    with open(file_path1, "rb") as g:
+                        if hasattr(os, "posix_fadvise"):
+                            os.posix_fadvise(g.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                        decoder.copy(g, f)
+                        if hasattr(os, "posix_fadvise"):
+                            os.posix_fadvise(g.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            f.truncate()
 
 
 class HLS:
@@ -78,6 +229,7 @@ class HLS:
     EXT_X_KEY_METHOD = "METHOD"
     EXT_X_KEY_URI = "URI"
     EXT_X_KEY_IV = "IV"
+    URI_SPECIAL_PATTERN = re.compile(r"[:?#\s]|^[/.]|/\.|//")
 
     def __init__(self):
         self.ext_x_key = None
@@ -94,11 +246,16 @@ class HLS:
             result[k] = v
         return result
 
+    @staticmethod
+    def join(url_prefix: str, line: str) -> str:
+        if HLS.URI_SPECIAL_PATTERN.search(line):
+            return urljoin(url_prefix, line)
+        return url_prefix + line
+
     @staticmethod
     def parse(url: str, get: Get) -> 'HLS':
         bs = BS(get)
-        url_prefix, _ = url.rsplit("/", 1)
-        url_prefix += "/"
+        url_prefix = urljoin(url, ".")
 
         hls = HLS()
         m3u8_url_list = []
@@ -106,17 +263,18 @@ class HLS:
 
         result = bs.get_str(url)
         for line in result.split("\n"):
+            line = line.strip()
             if not line.startswith("#"):
                 if line.endswith("m3u8"):
-                    m3u8_url_list.append(urljoin(url_prefix, line))
+                    m3u8_url_list.append(HLS.join(url_prefix, line))
                 if line.endswith("ts"):
-                    ts_url_list.append(urljoin(url_prefix, line))
+                    ts_url_list.append(HLS.join(url_prefix, line))
             else:
                 if line.startswith(HLS.EXT_X_KEY):
                     hls.ext_x_key = HLS.parse_ext_x_key(line)
                     if HLS.EXT_X_KEY_URI in hls.ext_x_key:
                         hls.ext_x_key_enc_key = bs.get_bytes(
-                            urljoin(url_prefix, hls.ext_x_key[HLS.EXT_X_KEY_URI].replace("\"", ""))
+                            HLS.join(url_prefix, hls.ext_x_key[HLS.EXT_X_KEY_URI].replace("\"", ""))
                         )
                     if HLS.EXT_X_KEY_IV in hls.ext_x_key:
                         hls.ext_x_key[HLS.EXT_X_KEY_IV] = bytes.fromhex(hls.ext_x_key[HLS.EXT_X_KEY_IV][2:])
@@ -124,9 +282,10 @@ class HLS:
         for m3u8_url in m3u8_url_list:
             result = bs.get_str(m3u8_url)
             for line in result.split("\n"):
+                line = line.strip()
                 if not line.startswith("#"):
                     if line.endswith("ts"):
-                        ts_url_list.append(urljoin(url_prefix, line))
+                        ts_url_list.append(HLS.join(url_prefix, line))
 
         hls.m3u8_url_list = m3u8_url_list
         hls.ts_url_list = ts_url_list
@@ -152,25 +311,28 @@ class HLS:
 
 class MTDownloader:
 
-    def __init__(self, url: str, directory: str, file_path: str):
+    def __init__(self, url: str, directory: str, file_path: str, max_workers: int = 16):
         self.session = requests.Session()
-
-        # def getter(u: str, f: IO):
-        #     response = self.session.get(u, stream=True)
-        #     if response.status_code != 200:
-        #         raise Exception(f"get {u} with status code {response.status_code}")
-        #     for chunk in response.iter_content(chunk_size=1024):
-        #         if chunk:
-        #             f.write(chunk)
+        self.max_workers = max_workers
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=max_workers,
+            max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504)),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Connection"] = "keep-alive"
 
         def getter(u: str, f: IO):
-            response = self.session.get(u)
-            if response.status_code != 200:
-                raise Exception(f"get {u} with status code {response.status_code}")
-            f.write(response.content)
+            with self.session.get(u, stream=True) as response:
+                if response.status_code != 200:
+                    raise Exception(f"get {u} with status code {response.status_code}")
+                response.raw.decode_content = True
+                shutil.copyfileobj(response.raw, f, length=1 << 16)
 
         self.hls = HLS.parse(url, getter)
         self.cache = Cache(directory, getter)
+        self.ts_file_path_list = [self.cache.get_file_path(ts_url) for ts_url in self.hls.ts_url_list]
         self.file_path = file_path
 
     def __enter__(self):
@@ -180,16 +342,13 @@ class MTDownloader:
         self.session.close()
 
     def download(self):
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = [executor.submit(self.cache.get, ts_url) for ts_url in self.hls.ts_url_list]
-            total = len(futures)
-            with tqdm(total=total) as bar:
-                while total > 0:
-                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
-                    for future in done:
-                        e = future.exception()
-                        if e is not None:
-                            raise e
-                    total -= len(done)
-                    bar.update(len(done))
-        self.cache.merge(self.hls.ts_url_list, self.file_path, self.hls.get_decoder())
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            ts_urls = dict(zip(self.ts_file_path_list, self.hls.ts_url_list))
+            futures = [executor.submit(self.cache.get, ts_url, ts_file_path) for ts_file_path, ts_url in ts_urls.items()]
+            with tqdm(total=len(futures), mininterval=0.5, smoothing=0.1) as bar:
+                for future in as_completed(futures):
+                    e = future.exception()
+                    if e is not None:
+                        raise e
+                    bar.update(1)
+        self.cache.merge(self.ts_file_path_list, self.file_path, self.hls.get_decoder())